@@ -31,13 +31,15 @@ selection_dictionary={"rpb1_1":[(1,846,"rpb1")],
 
 nproc = 5
 refrmf = 'run_1/all_ini.rmf3'
+# Same as table_fmt of AnalysisTrajectories
+table_fmt = 'csv'
 clustering_dir = sys.argv[1]
 
 AccuracyModels(selection_dictionary,
                clustering_dir=clustering_dir,
                ref_rmf3=refrmf,
-               scores_sample_A='analys/selected_models_A_cluster0_detailed.csv',
-               scores_sample_B='analys/selected_models_B_cluster0_detailed.csv',
+               scores_sample_A='analys/selected_models_A_cluster0_detailed.'+table_fmt,
+               scores_sample_B='analys/selected_models_B_cluster0_detailed.'+table_fmt,
                dir_name='run_',
                nproc=nproc)
 
@@ -37,8 +37,10 @@ gsms_B_dir = analys_dir+'GSMs_cl0/sample_B'
 AT.create_gsms_dir(gsms_A_dir)
 AT.create_gsms_dir(gsms_B_dir)
 
-HA = AT.get_models_to_extract('analys/selected_models_A_cluster0_random.csv')
-HB = AT.get_models_to_extract('analys/selected_models_B_cluster0_random.csv')
+HA = AT.get_models_to_extract(
+    'analys/selected_models_A_cluster0_random.'+AT.table_fmt)
+HB = AT.get_models_to_extract(
+    'analys/selected_models_B_cluster0_random.'+AT.table_fmt)
 AT.do_extract_models(HA, 'h1', gsms_A_dir)
 AT.do_extract_models(HB, 'h2', gsms_B_dir)
 
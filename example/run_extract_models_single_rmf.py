@@ -33,8 +33,8 @@ AT = AnalysisTrajectories(out_dirs,
                           nproc=nproc)
 
 # Point to the selected_models file
-HA = AT.get_models_to_extract('analys/selected_models_A_cluster'+str(c)+'_random.csv')
-HB = AT.get_models_to_extract('analys/selected_models_B_cluster'+str(c)+'_random.csv')
+HA = AT.get_models_to_extract('analys/selected_models_A_cluster'+str(c)+'_random.'+AT.table_fmt)
+HB = AT.get_models_to_extract('analys/selected_models_B_cluster'+str(c)+'_random.'+AT.table_fmt)
 
 rmf_file_out_A = 'A_models_clust'+str(c)+'.rmf3'
 rmf_file_out_B = 'B_models_clust'+str(c)+'.rmf3'
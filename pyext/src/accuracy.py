@@ -15,6 +15,8 @@ mpl.use('Agg')
 import matplotlib.pylab as pl  # noqa: E402
 mpl.rcParams.update({'font.size': 8})
 
+import tools  # noqa: E402
+
 
 class AccuracyModels(object):
     def __init__(self,
@@ -104,8 +106,8 @@ class AccuracyModels(object):
 
     def read_scores_files(self):
         # Read scores from file
-        S1 = pd.read_table(self.scores_sample_A, sep=',')
-        S2 = pd.read_table(self.scores_sample_B, sep=',')
+        S1 = tools.read_table(self.scores_sample_A)
+        S2 = tools.read_table(self.scores_sample_B)
         self.S = pd.concat([S1, S2])
 
         # Read identities of models, and put into dictionary
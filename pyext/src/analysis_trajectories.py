@@ -7,17 +7,34 @@ Tools to analyze PMI MC runs
 from __future__ import division
 
 import os
+import re
+import ast
 import math
 import glob
 import shutil
 import random
+import operator
 import itertools
 import subprocess
 import pandas as pd
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
 from equilibration import detectEquilibration
-import hdbscan
+import tools
+
+# HDBSCAN implementation, the GPU (cuml) and numba (fast_hdbscan)
+# ones are used when available
+try:
+    from cuml.cluster import HDBSCAN
+    hdbscan_backend = 'cuml'
+except (ImportError, RuntimeError):
+    try:
+        from fast_hdbscan import HDBSCAN
+        hdbscan_backend = 'fast_hdbscan'
+    except ImportError:
+        from hdbscan import HDBSCAN
+        hdbscan_backend = 'hdbscan'
 
 import IMP
 import IMP.rmf
@@ -51,11 +68,39 @@ color_palette = [u'#4c72b0', u'#55a868', u'#c44e52', u'#8172b2', u'#ccb974',
                  u'#4c72b0', u'#55a868', u'#c44e52', u'#8172b2', u'#ccb974',
                  u'#64b5cd', u'#4c72b0', u'#55a868', u'#c44e52', u'#8172b2']
 
+# Columns with the individual (not summed) scores of each restraint type
+individual_score_patterns = {
+    'CR': re.compile(r'(?!.*sum).*CR_'),
+    'EV': re.compile(r'(?!.*sum).*EV_'),
+    'BR': re.compile(r'(?!.*sum).*BR_'),
+    'DR': re.compile(r'(?!.*sum).*DR_'),
+    'XLs': re.compile(r'(?!.*sum).*XLs_'),
+    'atomic_XLs': re.compile(r'(?!.*sum).*atomic_XLs_'),
+    'DOPE': re.compile(r'(?!.*sum).*DOPE_'),
+    'EM3D': re.compile(r'(?!.*sigma).*EM3D_'),
+    'Psi': re.compile(r'(?!.*sum).*Psi')}
+
+# Id of a XL in the name of its distance field
+XLs_id_pattern = re.compile(r'^[^|]*\|[^|]*\|([^.|]*)')
+
+# Analysis used by the workers of read_stat_files, sent once per worker
+worker_analysis = None
+
+
+def init_worker_analysis(analysis):
+    global worker_analysis
+    worker_analysis = analysis
+
+
+def read_worker_traj_info(traj_stat_files):
+    return worker_analysis.read_traj_info(traj_stat_files)
+
 
 class AnalysisTrajectories(object):
     def __init__(self, out_dirs, dir_name='run_', analysis_dir='analysis',
                  detect_equilibration=True, burn_in_fraction=0.02,
-                 nskip=20, nproc=1, number_models_out=29999, plot_fmt='pdf'):
+                 nskip=20, nproc=1, number_models_out=29999, plot_fmt='pdf',
+                 table_fmt='csv'):
         '''
         Analyze the ensemble of models obtained after structural sampling by
         filtering out the bad scoring models, and clustering the good scoring
@@ -89,6 +134,9 @@ class AnalysisTrajectories(object):
         python multiprocess module). Default is 1.
 
         @plot_fmt: file extensions for all plots created. Default is pdf.
+
+        @table_fmt: file format of the tables of models, one of csv,
+        csv.zst (zstd compressed csv) or parquet. Default is csv.
         '''
 
         self.out_dirs = [os.path.abspath(d) for d in out_dirs]
@@ -107,8 +155,17 @@ class AnalysisTrajectories(object):
                            "file types:", supported_fmts)
         self.plot_fmt = plot_fmt
 
+        # check if table_fmt is supported
+        supported_table_fmts = ['csv', 'csv.zst', 'parquet']
+        if table_fmt not in supported_table_fmts:
+            raise KeyError("table_fmt not found in supported file types:",
+                           supported_table_fmts)
+        self.table_fmt = table_fmt
+
         self.restraint_names = {}
         self.all_score_fields = []
+        # XLs columns of each header, by get_XLs_satisfaction
+        self.XLs_columns = {}
         self.rerun = False
 
         # report if equilibration detection has been requested
@@ -125,22 +182,19 @@ class AnalysisTrajectories(object):
         if not os.path.isdir(self.analysis_dir):
             os.mkdir(self.analysis_dir)
 
-        # For multiprocessing
-        self.manager = mp.Manager()
-        self.S_all = self.manager.dict()
-        self.S_info_all = self.manager.dict()
-        self.S_dist_all = self.manager.dict()
-        self.XLs_nuis = self.manager.dict()
+        # Scores, distances and info of all trajectories
+        self.S_all = {}
+        self.S_info_all = {}
+        self.S_dist_all = {}
 
         # Global sampling parameters
-        self.Sampling = self.manager.dict()
+        self.Sampling = {}
         s_vals = ['Number_of_replicas',
                   'N_equilibrated',
                   'N_total']
 
         for v in s_vals:
             self.Sampling[v] = []
-        self.Validation = self.manager.dict()
 
         # Define with restraints to analyze
         self.Connectivity_restraint = False
@@ -194,6 +248,8 @@ class AnalysisTrajectories(object):
         # Separate trajectories into two halves
         self.dir_halfA = np.sort(self.out_dirs)[::2]
         self.dir_halfB = np.sort(self.out_dirs)[1::2]
+        self.half_map = {d: ('A' if i % 2 == 0 else 'B')
+                         for i, d in enumerate(sorted(self.out_dirs))}
 
     def set_analyze_XLs_restraint(self,
                                   get_nuisances=True,
@@ -337,13 +393,13 @@ class AnalysisTrajectories(object):
                     score_names.append(self.restraint_names[restraint]+'_sum')
                 else:
                     score_names.append(self.restraint_names[restraint])
-                score_fields += RES.values()
+                score_fields.extend(RES.values())
             else:
                 for k, v in RES.items():
                     score_names.append(
                         self.restraint_names[restraint] + '_'
                         + k.split(restraint + '_')[-1])
-                    score_fields += [v]
+                    score_fields.append(v)
 
         return score_fields, score_names
 
@@ -378,6 +434,19 @@ class AnalysisTrajectories(object):
 
         return list(info_names), info_fields
 
+    def get_stat_fields(self, stat2_dict):
+        '''
+        Get the rmf file, score, distance and info fields
+        of a stat file header
+        '''
+        query_rmf_file = self.get_field_id(stat2_dict, 'rmf_file')
+        score_fields, score_names = self.get_score_fields(stat2_dict)
+        dist_names, dist_fields = self.get_distance_fields(stat2_dict)
+        info_names, info_fields = self.get_info_fields(stat2_dict)
+
+        return (query_rmf_file, score_fields, score_names, dist_names,
+                dist_fields, info_names, info_fields)
+
     def read_DB(self, db_file):
         ''' Read database '''
         DB = {}
@@ -393,29 +462,28 @@ class AnalysisTrajectories(object):
     def get_keys(self, stat_file):
         ''' Get all keys in stat file '''
 
+        # Only the header line is needed
         with open(stat_file, "r") as of:
-            stat_file_lines = of.readlines()
-        for line in stat_file_lines:
-            d = eval(line)
-            klist = list(d.keys())
-            # check if it is a stat2 file
-            if "STAT2HEADER" in klist:
-                import operator
-                for k in klist:
-                    if "STAT2HEADER" in str(k):
-                        del d[k]
-                stat2_dict = d
-                # get the list of keys sorted by value
-                kkeys = [k[0] for k in sorted(stat2_dict.items(),
-                                              key=operator.itemgetter(1))]
-                klist = [k[1] for k in sorted(stat2_dict.items(),
-                                              key=operator.itemgetter(1))]
-                invstat2_dict = {}
-                for k in kkeys:
-                    invstat2_dict.update({stat2_dict[k]: k})
-            else:
-                klist.sort()
-            break
+            for line in of:
+                d = ast.literal_eval(line)
+                klist = list(d.keys())
+                # check if it is a stat2 file
+                if "STAT2HEADER" in klist:
+                    for k in klist:
+                        if "STAT2HEADER" in str(k):
+                            del d[k]
+                    stat2_dict = d
+                    # get the list of keys sorted by value
+                    kkeys = [k[0] for k in sorted(stat2_dict.items(),
+                                                  key=operator.itemgetter(1))]
+                    klist = [k[1] for k in sorted(stat2_dict.items(),
+                                                  key=operator.itemgetter(1))]
+                    invstat2_dict = {}
+                    for k in kkeys:
+                        invstat2_dict.update({stat2_dict[k]: k})
+                else:
+                    klist.sort()
+                break
 
         return stat2_dict
 
@@ -424,26 +492,44 @@ class AnalysisTrajectories(object):
 
         self.Sampling['Number_of_runs'] = len(self.out_dirs)
 
-        # Split directories
-        ND = int(np.ceil(len(self.out_dirs)/float(self.nproc)))
-        out_dirs_dict = {}
-        for k in range(self.nproc-1):
-            out_dirs_dict[k] = list(self.out_dirs[(k*ND):(k*ND+ND)])
-        out_dirs_dict[self.nproc-1] = \
-            list(self.out_dirs[((self.nproc-1)*ND):(len(self.out_dirs))])
-
-        # Setup a list of processes that we want to run
-        processes = [mp.Process(target=self.read_traj_info,
-                                args=((out_dirs_dict[x], )))
-                     for x in range(self.nproc)]
-
-        # Run processes
-        for p in processes:
-            p.start()
-
-        # Exit the completed processes
-        for p in processes:
-            p.join()
+        # List the stat files of all trajectories once
+        stat_files = [(out, sorted(glob.glob(os.path.join(out, 'stat.*.out'))))
+                      for out in self.out_dirs]
+
+        # Workers and parent must share the tracker of the shared
+        # memory blocks, so that the parent can release them
+        resource_tracker.ensure_running()
+
+        # Each worker returns the results of one trajectory, collected
+        # in completion order so uneven runs do not hold up the others.
+        # The analysis is sent to each worker once, when it starts, and
+        # tasks only carry the stat files. Results are kept apart until
+        # all tasks are sent.
+        S_all = {}
+        S_dist_all = {}
+        S_info_all = {}
+        samplings = []
+        with mp.Pool(self.nproc, initializer=init_worker_analysis,
+                     initargs=(self, )) as p:
+            for out, S_scores, S_dist, S_info, sampling in p.imap_unordered(
+                    read_worker_traj_info, stat_files, chunksize=1):
+                try:
+                    S_all[out] = self.frame_from_shared_memory(S_scores)
+                    if S_dist is not None:
+                        S_dist_all[out] = self.frame_from_shared_memory(S_dist)
+                    if S_info is not None:
+                        S_info_all[out] = self.frame_from_shared_memory(S_info)
+                finally:
+                    # Do not leave blocks behind if a rebuild failed
+                    self.release_shared_memory([S_scores, S_dist, S_info])
+                samplings.append(sampling)
+
+        self.S_all.update(S_all)
+        self.S_dist_all.update(S_dist_all)
+        self.S_info_all.update(S_info_all)
+        for sampling in samplings:
+            for k, v in sampling.items():
+                self.Sampling[k].append(v)
 
     def read_stats_detailed(self,
                             traj,
@@ -458,88 +544,86 @@ class AnalysisTrajectories(object):
         S_dist = []
         P_info = []
 
+        # Fields and columns to extract for each distinct header.
+        # All replicas of a trajectory usually share the same header.
+        header_fields = {}
+
         for sf in stat_files:
             # Read header
             stat2_dict = self.get_keys(sf)
-            # Get fields to extract
-            query_rmf_file = self.get_field_id(stat2_dict, 'rmf_file')
-
-            # Compile fields to read
-            score_fields, score_names = self.get_score_fields(stat2_dict)
-            dist_names, dist_fields = self.get_distance_fields(stat2_dict)
-            info_names, info_fields = self.get_info_fields(stat2_dict)
-
-            line_number = 0
-            with open(sf, "r") as of:
-                sf_lines = of.readlines()
-
-            for line in sf_lines:
-                line_number += 1
-                try:
-                    d = eval(line)
-                except:  # noqa: E722
-                    print("# Warning: skipped line number "
-                          + str(line_number) + " not a valid line")
-                    break
-
-                if line_number > 1:
-                    frmf = [d[field] for field in query_rmf_file][0]
-                    s0 = [float(d[field])
-                          for field in score_fields] + [traj, frmf]
-                    S_scores.append(s0)
-                    if len(dist_fields) > 0:
-                        d0 = [s0[0]] + [
-                            float(d[field]) for field in dist_fields]
-                        S_dist.append(d0)
-                    if len(info_fields) > 0:
-                        p0 = [s0[0]] + [
-                            float(d[field]) for field in info_fields]
-                        P_info.append(p0)
-
-        # Sort based on frame
-        S_scores.sort(key=lambda x: float(x[0]))
-
-        # Convert into pandas DF
-        column_names = [x for x in score_names] + ['traj', 'rmf3_file']
-        DF = pd.DataFrame(S_scores, columns=column_names)
-
-        # If some restraints need to be added
+            header = tuple(stat2_dict.items())
+            if header not in header_fields:
+                header_fields[header] = self.get_header_columns(stat2_dict)
+            (query_rmf_file, score_names, dist_names, info_names, fields,
+             n_scores, dist_idx, info_idx) = header_fields[header]
+
+            # Read all values of the file as a float array
+            values, rmf_files = self.read_stat_values(sf, fields,
+                                                      query_rmf_file[0])
+
+            DF_sf = pd.DataFrame(values[:, :n_scores], columns=score_names)
+            DF_sf['traj'] = traj
+            DF_sf['rmf3_file'] = rmf_files
+            S_scores.append(DF_sf)
+            S_dist.append(values.take(dist_idx, axis=1))
+            P_info.append(values.take(info_idx, axis=1))
+
+        DF = pd.concat(S_scores, ignore_index=True)
+        S_dist = np.concatenate(S_dist)
+        P_info = np.concatenate(P_info)
+
+        # Sort based on frame, using the same order for all blocks.
+        # Frames of a single stat file are already in order.
+        frames = S_dist[:, 0]
+        if np.any(frames[1:] < frames[:-1]):
+            order = np.argsort(frames, kind='stable')
+            DF = DF.take(order).reset_index(drop=True)
+            S_dist = S_dist[order]
+            P_info = P_info[order]
+
+        # Columns of each restraint type, found in a single pass
+        restraint_types = ['XLs_', 'atomic_XLs_', 'EV_', 'CR_', 'BR_', 'DR_',
+                           'MEX_', 'MSL_']
+        restraint_types += [key + "_" for key in self.sum_score_only_restraint]
+        type_columns = self.get_restraint_type_columns(score_names,
+                                                       restraint_types)
+        scores = DF[score_names].to_numpy()
+
+        # If some restraints need to be added, all sums are
+        # added to the DataFrame at once
+        sums = {}
         if self.XLs_restraint and self.sum_XLs_restraint:
-            XLs_sum = pd.Series(self.add_restraint_type(DF, 'XLs_'))
-            DF = DF.assign(XLs_sum=XLs_sum.values)
+            sums['XLs_sum'] = self.add_restraint_type(
+                scores, type_columns['XLs_'])
 
         if self.atomic_XLs_restraint and self.sum_atomic_XLs_restraint:
-            atomic_XLs_sum = pd.Series(
-                self.add_restraint_type(DF, 'atomic_XLs_'))
-            DF = DF.assign(atomic_XLs_sum=atomic_XLs_sum.values)
+            sums['atomic_XLs_sum'] = self.add_restraint_type(
+                scores, type_columns['atomic_XLs_'])
 
-        all_EV = [res for res in score_names if 'EV_' in res]
-        if len(all_EV) > 1:
-            EV_sum = pd.Series(self.add_restraint_type(DF, 'EV_'))
-            DF = DF.assign(EV_sum=EV_sum.values)
+        if len(type_columns['EV_']) > 1:
+            sums['EV_sum'] = self.add_restraint_type(
+                scores, type_columns['EV_'])
 
-        all_CR = [res for res in score_names if 'CR_' in res]
-        if len(all_CR) > 1:
-            CR_sum = pd.Series(self.add_restraint_type(DF, 'CR_'))
-            DF = DF.assign(CR_sum=CR_sum.values)
+        if len(type_columns['CR_']) > 1:
+            sums['CR_sum'] = self.add_restraint_type(
+                scores, type_columns['CR_'])
 
-        all_BR = [res for res in score_names if 'BR_' in res]
-        if len(all_BR) > 1:
-            BR_sum = pd.Series(self.add_restraint_type(DF, 'BR_'))
-            DF = DF.assign(BR_sum=BR_sum.values)
+        if len(type_columns['BR_']) > 1:
+            sums['BR_sum'] = self.add_restraint_type(
+                scores, type_columns['BR_'])
 
         if self.Distance_restraint and self.sum_Distance_restraint:
-            DR_sum = pd.Series(self.add_restraint_type(DF, 'DR_'))
-            DF = DF.assign(DR_sum=DR_sum.values)
+            sums['DR_sum'] = self.add_restraint_type(
+                scores, type_columns['DR_'])
         if self.MembraneExclusion_restraint \
                 and self.sum_MembraneExclusion_restraint:
-            MEX_sum = pd.Series(self.add_restraint_type(DF, 'MEX_'))
-            DF = DF.assign(MEX_sum=MEX_sum.values)
+            sums['MEX_sum'] = self.add_restraint_type(
+                scores, type_columns['MEX_'])
 
         if self.MembraneExclusion_restraint \
                 and self.sum_MembraneExclusion_restraint:
-            MSL_sum = pd.Series(self.add_restraint_type(DF, 'MSL_'))
-            DF = DF.assign(MSL_sum=MSL_sum.values)
+            sums['MSL_sum'] = self.add_restraint_type(
+                scores, type_columns['MSL_'])
 
         # if some score only type custom restraints defined by the user
         # need to be summed. Because of the do_sum flag available while
@@ -550,178 +634,332 @@ class AnalysisTrajectories(object):
         if self.score_only_restraint:
             for key, do_sum in self.sum_score_only_restraint.items():
                 prefix = key + "_"
-                all_restraint = [res for res in score_names if prefix in res]
-                if len(all_restraint) > 1 and do_sum:
-                    this_restraint_sum = pd.Series(
-                        self.add_restraint_type(DF, prefix))
-                    sum_dict = {prefix + "sum": this_restraint_sum.values}
-                    DF = DF.assign(**sum_dict)
+                if len(type_columns[prefix]) > 1 and do_sum:
+                    sums[prefix + "sum"] = self.add_restraint_type(
+                        scores, type_columns[prefix])
+
+        DF = DF.assign(**sums)
+
+        DF = self.to_single_precision(DF)
 
         # Get distance fields
         if len(dist_names) > 0:
-            S_dist = np.array(S_dist)
-            S_dist = S_dist[S_dist[:, 0].argsort()]
             # Convert in DF
             DF_dXLs = pd.DataFrame(S_dist, columns=['MC_frame'] + dist_names)
+            DF_dXLs = self.to_single_precision(DF_dXLs)
 
         if len(info_names) > 0:
-            P_info = np.array(P_info)
-            P_info = P_info[P_info[:, 0].argsort()]
             DF_info = pd.DataFrame(P_info, columns=['MC_frame'] + info_names)
+            DF_info = self.to_single_precision(DF_info)
 
         # return DF, DF_XLs, P_satif, frames_dic
-        if dist_fields and info_fields:
+        if dist_names and info_names:
             return DF, DF_dXLs, DF_info
-        elif dist_fields and not info_fields:
+        elif dist_names and not info_names:
             return DF, DF_dXLs, None
-        elif not dist_fields and info_fields:
+        elif not dist_names and info_names:
             return DF, None, DF_info
         else:
             return DF, None, None
 
-    def add_restraint_type(self, DF, key_id):
-        temp_fields = [v for v in DF.columns.values if key_id in v]
-        DF_t = DF[temp_fields]
-        DF_s = DF_t.sum(axis=1)
-        return DF_s
+    def get_header_columns(self, stat2_dict):
+        '''
+        Get the fields to read from a stat file header, and the
+        columns of the distances and info blocks in the array of
+        values. The frame number goes first in both blocks.
+        '''
+        (query_rmf_file, score_fields, score_names, dist_names,
+         dist_fields, info_names, info_fields) = \
+            self.get_stat_fields(stat2_dict)
+
+        fields = score_fields + dist_fields + info_fields
+        n_scores = len(score_fields)
+        n_dist = len(dist_fields)
+        dist_idx = np.r_[0, n_scores:n_scores+n_dist]
+        info_idx = np.r_[0, n_scores+n_dist:len(fields)]
 
-    def read_traj_info(self, out_dirs_sel):
-        # Dictionary to put the scores of all the trajectories
-        # files_dic: keys: frames, values: rmf3 file
+        return (query_rmf_file, score_names, dist_names, info_names, fields,
+                n_scores, dist_idx, info_idx)
 
-        if isinstance(out_dirs_sel, str):
-            out_dirs_sel = [out_dirs_sel]
+    def read_stat_values(self, stat_file, fields, rmf_field):
+        '''
+        Read the selected fields of all frames in a stat file into
+        a float array, along with the rmf file of each frame
+        '''
+        get_values = self.get_fields_getter(fields)
+        get_rmf_file = operator.itemgetter(rmf_field)
+
+        with open(stat_file, "r", buffering=1 << 20) as of:
+            # One row per frame, the first line is the header
+            n_frames = max(sum(1 for line in of) - 1, 0)
+            values = np.empty((n_frames, len(fields)))
+            rmf_files = np.empty(n_frames, dtype=object)
+            n_read = 0
+
+            # Skip the header, it was already read by get_keys
+            of.seek(0)
+            next(of, None)
+            for line in of:
+                try:
+                    d = ast.literal_eval(line)
+                except (ValueError, SyntaxError):
+                    print("# Warning: skipped line number "
+                          + str(n_read + 2) + " not a valid line")
+                    break
 
-        for out in out_dirs_sel:
-            if self.dir_name in out:
-                traj = [x for x in out.split('/') if self.dir_name in x][0]
-                traj_number = int(traj.split(self.dir_name)[1])
-            else:
-                traj = 0
-                traj_number = 0
-            stat_files = sorted(glob.glob(os.path.join(out, 'stat.*.out')))
-            self.Sampling['Number_of_replicas'] += [len(stat_files)]
-
-            # Read all stat files of trajectory
-            S_tot_scores, S_dist, S_info = self.read_stats_detailed(traj,
-                                                                    stat_files)
-
-            n_frames = len(S_tot_scores)
-            burn_in = int(self.burn_in_frac * n_frames)
-            print('The mean score, min score, and n frames are: ', traj_number,
-                  np.mean(S_tot_scores['Total_Score'].iloc[burn_in:]),
-                  np.min(S_tot_scores['Total_Score'].iloc[burn_in:]),
-                  n_frames)
-            self.Sampling['N_total'] = self.Sampling['N_total'] + [n_frames]
-
-            # Selection of just sums (default)
-            sel_entries = ['Total_Score'] + [
-                    v for v in S_tot_scores.columns.values if 'sum' in v]
-
-            # If specified by user, can look at individual contributions
-            if self.Connectivity_restraint \
-                    and not self.sum_Connectivity_restraint:
-                sel_entries += [v for v in S_tot_scores.columns.values
-                                if 'CR_' in v and 'sum' not in v]
-            if self.Excluded_volume_restraint \
-                    and not self.sum_Excluded_volume_restraint:
-                sel_entries += [v for v in S_tot_scores.columns.values
-                                if 'EV_' in v and 'sum' not in v]
-            if self.Binding_restraint and not self.sum_Binding_restraint:
-                sel_entries += [v for v in S_tot_scores.columns.values
-                                if 'BR_' in v and 'sum' not in v]
-            if self.Distance_restraint and not self.sum_Distance_restraint:
-                sel_entries += [v for v in S_tot_scores.columns.values
-                                if 'DR_' in v and 'sum' not in v]
-            if self.XLs_restraint and not self.sum_XLs_restraint:
-                sel_entries += [v for v in S_tot_scores.columns.values
-                                if 'XLs_' in v and 'sum' not in v]
-            if self.atomic_XLs_restraint and not self.sum_atomic_XLs_restraint:
-                sel_entries += [v for v in S_tot_scores.columns.values
-                                if 'atomic_XLs_' in v and 'sum' not in v]
-            if self.DOPE_restraint and not self.sum_DOPE_restraint:
-                sel_entries += [v for v in S_tot_scores.columns.values
-                                if 'DOPE_' in v and 'sum' not in v]
-            if self.EM_restraint and not self.sum_EM_restraint:
-                sel_entries += [v for v in S_tot_scores.columns.values
-                                if 'EM3D_' in v and 'sigma' not in v]
+                values[n_read] = get_values(d)
+                rmf_files[n_read] = get_rmf_file(d)
+                n_read += 1
+
+        # Drop the rows of frames that were not read
+        return values[:n_read], rmf_files[:n_read]
+
+    def get_restraint_type_columns(self, score_names, key_ids):
+        '''
+        For each restraint type, get the positions of the
+        score columns that contain its key
+        '''
+        type_columns = {k: [] for k in key_ids}
+        for i, v in enumerate(score_names):
+            for k in key_ids:
+                if k in v:
+                    type_columns[k].append(i)
+        return type_columns
+
+    def add_restraint_type(self, scores, columns):
+        '''
+        Sum the scores array over the selected columns
+        '''
+        return np.nansum(scores[:, columns], axis=1)
+
+    def keep_double_precision(self, column):
+        '''
+        Whether a column is kept in double precision: frame indices so
+        they stay exact, and the total score and score sums, which are
+        large enough for float32 to lose their decimals
+        '''
+        return (column in ['MC_frame', 'rmf_frame_index', 'Total_Score']
+                or 'sum' in column)
+
+    def to_single_precision(self, DF):
+        '''
+        Convert the per-restraint float columns to float32 to halve
+        their memory
+        '''
+        columns = [v for v in DF.select_dtypes('float64').columns.values
+                   if not self.keep_double_precision(v)]
+        return DF.astype({v: np.float32 for v in columns})
 
+    def read_traj_info(self, traj_stat_files):
+        '''
+        Read and analyze all stat files of a single trajectory, given as
+        a (directory, stat files) pair.
+        Returns the post-equilibration scores, distances and info
+        DataFrames, together with the sampling counts of the trajectory.
+        '''
+        out, stat_files = traj_stat_files
+        if self.dir_name in out:
+            traj = [x for x in out.split('/') if self.dir_name in x][0]
+            traj_number = int(traj.split(self.dir_name)[1])
+        else:
+            traj = 0
+            traj_number = 0
+        sampling = {'Number_of_replicas': len(stat_files)}
+
+        # Read all stat files of trajectory
+        S_tot_scores, S_dist, S_info = self.read_stats_detailed(traj,
+                                                                stat_files)
+
+        n_frames = len(S_tot_scores)
+        burn_in = int(self.burn_in_frac * n_frames)
+        print('The mean score, min score, and n frames are: ', traj_number,
+              np.mean(S_tot_scores['Total_Score'].iloc[burn_in:]),
+              np.min(S_tot_scores['Total_Score'].iloc[burn_in:]),
+              n_frames)
+        sampling['N_total'] = n_frames
+
+        # Selection of just sums (default)
+        sel_entries = ['Total_Score'] + [
+                v for v in S_tot_scores.columns.values if 'sum' in v]
+
+        # If specified by user, can look at individual contributions
+        individual_scores = [
+            ('CR', self.Connectivity_restraint
+             and not self.sum_Connectivity_restraint),
+            ('EV', self.Excluded_volume_restraint
+             and not self.sum_Excluded_volume_restraint),
+            ('BR', self.Binding_restraint and not self.sum_Binding_restraint),
+            ('DR', self.Distance_restraint
+             and not self.sum_Distance_restraint),
+            ('XLs', self.XLs_restraint and not self.sum_XLs_restraint),
+            ('atomic_XLs', self.atomic_XLs_restraint
+             and not self.sum_atomic_XLs_restraint),
+            ('DOPE', self.DOPE_restraint and not self.sum_DOPE_restraint),
+            ('EM3D', self.EM_restraint and not self.sum_EM_restraint),
             # Also add nuisances parameter
-            sel_entries += [v for v in S_tot_scores.columns.values
-                            if 'Psi' in v and 'sum' not in v]
-
-            # Detect equilibration time if requested
-            ts_eq = []
-            if self.detect_equilibration:
-                for r in sel_entries:
-                    try:
-                        [t, g, N] = detectEquilibration(
-                            np.array(S_tot_scores[r].loc[burn_in:]),
-                            nskip=self.nskip)
-                        ts_eq.append(t)
-                    except (ValueError, TypeError):
-                        ts_eq.append(0)
-                print('Trajectory, ts_eqs: ', traj, ts_eq)
+            ('Psi', True)]
+        for restraint, selected in individual_scores:
+            if selected:
+                pattern = individual_score_patterns[restraint]
+                sel_entries += [v for v in S_tot_scores.columns.values
+                                if pattern.match(v)]
+
+        # Detect equilibration time if requested
+        ts_eq = []
+        if self.detect_equilibration:
+            # Selected scores after burn-in, one column per entry
+            sel_scores = S_tot_scores[sel_entries].iloc[burn_in:].to_numpy()
+            for i in range(len(sel_entries)):
+                try:
+                    [t, g, N] = detectEquilibration(
+                        sel_scores[:, i], nskip=self.nskip)
+                    ts_eq.append(t)
+                except (ValueError, TypeError):
+                    ts_eq.append(0)
+            print('Trajectory, ts_eqs: ', traj, ts_eq)
+        else:
+            ts_eq = [0]*len(sel_entries)
+
+        ts_max = np.max(ts_eq) + burn_in
+        sampling['N_equilibrated'] = n_frames - ts_max
+
+        # Plot the scores and restraint satisfaction
+        file_out = 'plot_scores_%s.%s' % (traj_number, self.plot_fmt)
+        self.plot_scores_restraints(
+            S_tot_scores[['MC_frame']+sel_entries], ts_eq, burn_in,
+            file_out)
+
+        if self.pEMAP_restraint_new:
+            file_out_pemap = 'plot_pEMAP_%s.%s' \
+                % (traj_number, self.plot_fmt)
+            self.plot_pEMAP_satisfaction(S_info, file_out_pemap)
+
+        if self.Occams_restraint:
+            file_out_occams = 'plot_Occams_satisfaction_%s.%s' \
+                % (traj_number, self.plot_fmt)
+            self.plot_Occams_satisfaction(S_info, file_out_occams)
+
+        # Check how many XLs are satisfied
+        if self.XLs_restraint:
+            S_info = self.analyze_trajectory_XLs(S_dist, S_info,
+                                                 atomic_XLs=False,
+                                                 traj_number=traj_number,
+                                                 ts_max=ts_max)
+
+        if self.atomic_XLs_restraint:
+            S_info = self.analyze_trajectory_XLs(S_dist, S_info,
+                                                 atomic_XLs=True,
+                                                 traj_number=traj_number,
+                                                 ts_max=ts_max)
+
+        # Add half info
+        S_tot_scores = S_tot_scores.assign(half=self.half_map.get(out, 0))
+
+        # Collect distances and nuisances information, the frames
+        # are handed back to the parent through shared memory
+        shared = []
+        try:
+            if S_info is not None:
+                S_info = self.frame_to_shared_memory(S_info[ts_max:])
+                shared.append(S_info)
             else:
-                ts_eq = [0]*len(sel_entries)
-
-            ts_max = np.max(ts_eq) + burn_in
-            self.Sampling['N_equilibrated'] += [n_frames - ts_max]
-
-            # Plot the scores and restraint satisfaction
-            file_out = 'plot_scores_%s.%s' % (traj_number, self.plot_fmt)
-            self.plot_scores_restraints(
-                S_tot_scores[['MC_frame']+sel_entries], ts_eq, burn_in,
-                file_out)
-
-            if self.pEMAP_restraint_new:
-                file_out_pemap = 'plot_pEMAP_%s.%s' \
-                    % (traj_number, self.plot_fmt)
-                self.plot_pEMAP_satisfaction(S_info, file_out_pemap)
-
-            if self.Occams_restraint:
-                file_out_occams = 'plot_Occams_satisfaction_%s.%s' \
-                    % (traj_number, self.plot_fmt)
-                self.plot_Occams_satisfaction(S_info, file_out_occams)
-
-            # Check how many XLs are satisfied
-            if self.XLs_restraint:
-                S_info = self.analyze_trajectory_XLs(S_dist, S_info,
-                                                     atomic_XLs=False,
-                                                     traj_number=traj_number,
-                                                     ts_max=ts_max)
-
-            if self.atomic_XLs_restraint:
-                S_info = self.analyze_trajectory_XLs(S_dist, S_info,
-                                                     atomic_XLs=True,
-                                                     traj_number=traj_number,
-                                                     ts_max=ts_max)
-
-            # Add half info
-            if out in self.dir_halfA:
-                S_tot_scores = S_tot_scores.assign(
-                    half=pd.Series(['A']*len(S_tot_scores),
-                                   index=S_tot_scores.index).values)
-            elif out in self.dir_halfB:
-                S_tot_scores = S_tot_scores.assign(
-                    half=pd.Series(['B']*len(S_tot_scores),
-                                   index=S_tot_scores.index).values)
+                print('No S_info')
+            if self.XLs_restraint or self.atomic_XLs_restraint:
+                S_dist = self.frame_to_shared_memory(S_dist[ts_max:])
+                shared.append(S_dist)
             else:
-                S_tot_scores = S_tot_scores.assign(
-                    half=pd.Series([0]*len(S_tot_scores),
-                                   index=S_tot_scores.index).values)
+                S_dist = None
+            S_tot_scores = self.frame_to_shared_memory(
+                S_tot_scores[ts_max:])
+        except BaseException:
+            # The parent never sees the blocks created so far
+            self.release_shared_memory(shared)
+            raise
+
+        return out, S_tot_scores, S_dist, S_info, sampling
+
+    def frame_to_shared_memory(self, DF):
+        '''
+        Copy the numeric columns of a DataFrame into a new shared memory
+        block, one column after the other.
+        Returns what is needed to rebuild the DataFrame in another
+        process with frame_from_shared_memory, or the DataFrame itself
+        if the block does not fit in shared memory
+        '''
+        columns = list(DF.columns.values)
+        numeric = [v for v in columns if DF[v].dtype.kind in 'fiu']
+        size = sum(DF[v].dtype.itemsize for v in numeric) * len(DF)
+        if not self.shared_memory_fits(size):
+            return DF
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+        layout = []
+        offset = 0
+        try:
+            for v in numeric:
+                values = DF[v].to_numpy()
+                np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf,
+                           offset=offset)[:] = values
+                layout.append((v, values.dtype.str, offset))
+                offset += values.nbytes
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        shm.close()
+
+        others = {v: DF[v].to_numpy() for v in columns if v not in numeric}
+        return shm.name, DF.index, columns, layout, others
+
+    def shared_memory_fits(self, size):
+        '''
+        Whether a shared memory block of size bytes fits in /dev/shm,
+        leaving room for the blocks of the other workers. Creating a
+        block larger than the free space succeeds, but filling it kills
+        the worker with SIGBUS.
+        '''
+        try:
+            stat = os.statvfs('/dev/shm')
+        except (OSError, AttributeError):
+            # No size limited /dev/shm on this platform
+            return True
+        return size * self.nproc <= stat.f_bavail * stat.f_frsize
 
-            # Collect distances and nuisances information
+    def frame_from_shared_memory(self, shared_frame):
+        '''
+        Rebuild a DataFrame written by frame_to_shared_memory
+        and release its shared memory block
+        '''
+        if isinstance(shared_frame, pd.DataFrame):
+            return shared_frame
+        name, index, columns, layout, others = shared_frame
+        shm = shared_memory.SharedMemory(name=name)
 
-            self.S_all[out] = S_tot_scores[ts_max:]
+        data = dict(others)
+        try:
+            for v, dtype, offset in layout:
+                data[v] = np.ndarray(len(index), dtype=dtype, buffer=shm.buf,
+                                     offset=offset).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    def release_shared_memory(self, shared_frames):
+        '''
+        Unlink the shared memory blocks of frames that were not
+        rebuilt by frame_from_shared_memory
+        '''
+        for shared_frame in shared_frames:
+            if shared_frame is None or isinstance(shared_frame,
+                                                  pd.DataFrame):
+                continue
             try:
-                self.S_info_all[out] = S_info[ts_max:]
-            except:  # noqa: E722
-                print('No S_info')
-            if self.XLs_restraint:
-                self.S_dist_all[out] = S_dist[ts_max:]
-            if self.atomic_XLs_restraint:
-                self.S_dist_all[out] = S_dist[ts_max:]
+                shm = shared_memory.SharedMemory(name=shared_frame[0])
+            except FileNotFoundError:
+                continue
+            shm.close()
+            shm.unlink()
 
     def get_field_id(self, dict, val):
         '''
@@ -729,6 +967,18 @@ class AnalysisTrajectories(object):
         '''
         return [k for k in dict.keys() if dict[k] == val]
 
+    def get_fields_getter(self, fields):
+        '''
+        Get a function that returns the values of all fields
+        of a stat file line as a tuple
+        '''
+        if len(fields) == 0:
+            return lambda d: ()
+        elif len(fields) == 1:
+            field = fields[0]
+            return lambda d: (d[field], )
+        return operator.itemgetter(*fields)
+
     def plot_scores_restraints(self, selected_scores, ts_eq, burn_in,
                                file_out):
         '''
@@ -738,11 +988,15 @@ class AnalysisTrajectories(object):
         ts_max = np.max(ts_eq)
         n_res = len(selected_scores.columns.values)-1
 
+        # Frames and scores as arrays, the frames have a RangeIndex
+        frames = selected_scores['MC_frame'].to_numpy()
+        scores = {c: selected_scores[c].to_numpy()
+                  for c in selected_scores.columns.values[1:]}
+
         fig, ax = pl.subplots(figsize=(2.0*n_res, 4.0), nrows=2, ncols=n_res)
         axes = ax.flatten()
         for i, c in enumerate(selected_scores.columns.values[1:]):
-            axes[i].plot(selected_scores['MC_frame'].loc[burn_in::10],
-                         selected_scores[c].loc[burn_in::10],
+            axes[i].plot(frames[burn_in::10], scores[c][burn_in::10],
                          color='b', alpha=0.5)
             axes[i].axvline(ts_eq[i], color='grey')
             axes[i].set_title(c, fontsize=14)
@@ -751,10 +1005,10 @@ class AnalysisTrajectories(object):
                 axes[i].set_ylabel('Score (a.u.)', fontsize=12)
 
         for i, c in enumerate(selected_scores.columns.values[1:]):
-            axes[i+n_res].hist(selected_scores[c].loc[ts_eq[i]::10],
+            axes[i+n_res].hist(scores[c][ts_eq[i]::10],
                                n_bins, histtype='step', fill=False,
                                color='orangered', alpha=0.9)
-            axes[i+n_res].hist(selected_scores[c].loc[ts_max::10],
+            axes[i+n_res].hist(scores[c][ts_max::10],
                                n_bins, histtype='step', fill=False,
                                color='gold', alpha=0.9)
             axes[i+n_res].set_xlabel('Score (a.u.)', fontsize=12)
@@ -772,20 +1026,37 @@ class AnalysisTrajectories(object):
 
         for k, T in self.S_all.items():
             kk = k.split(self.dir_name)[-1].split('/')[0]
-            T.to_csv(os.path.join(os.path.join(
-                self.analysis_dir, 'scores_info_'+str(kk)+'.csv')))
+            self.write_table(T, 'scores_info_'+str(kk))
 
         for k in self.S_dist_all.keys():
             T = self.S_dist_all[k]
             kk = k.split(self.dir_name)[-1].split('/')[0]
-            T.to_csv(os.path.join(os.path.join(
-                self.analysis_dir, 'XLs_dist_info_'+str(kk)+'.csv')))
+            self.write_table(T, 'XLs_dist_info_'+str(kk))
 
         for k in self.S_info_all.keys():
             T = self.S_info_all[k]
             kk = k.split(self.dir_name)[-1].split('/')[0]
-            T.to_csv(os.path.join(os.path.join(
-                self.analysis_dir, 'other_info_'+str(kk)+'.csv')))
+            self.write_table(T, 'other_info_'+str(kk))
+
+    def write_table(self, DF, name):
+        '''
+        Write a table, with its index, to <name>.<table_fmt>
+        in the analysis directory
+        '''
+        f = os.path.join(self.analysis_dir, name + '.' + self.table_fmt)
+        if self.table_fmt == 'parquet':
+            DF.to_parquet(f, compression='zstd')
+        else:
+            # The compression of csv files is given by the extension
+            DF.to_csv(f)
+
+    def read_table(self, f):
+        '''
+        Read a table written by write_table. The columns of csv files
+        get the same dtypes as when reading the stat files.
+        '''
+        return tools.read_table(f, index_col=0,
+                                column_dtype=self.get_column_dtype)
 
     def read_models_info(self, XLs_cutoffs=None):
         '''
@@ -797,22 +1068,22 @@ class AnalysisTrajectories(object):
             self.XLs_cutoffs = XLs_cutoffs
 
         # Score files
-        info_files = glob.glob(
-            os.path.join(self.analysis_dir, 'scores_info_*.csv'))
+        info_files = glob.glob(os.path.join(
+            self.analysis_dir, 'scores_info_*.' + self.table_fmt))
         for f in info_files:
-            k = f.split('all_info_')[-1].split('.csv')[0]
-            df = pd.read_csv(f)
+            k = f.split('all_info_')[-1].split('.' + self.table_fmt)[0]
+            df = self.read_table(f)
             self.S_all[k] = df
 
         # XLs files
-        xls_files = glob.glob(
-            os.path.join(self.analysis_dir, 'XLs_dist_info_*.csv'))
+        xls_files = glob.glob(os.path.join(
+            self.analysis_dir, 'XLs_dist_info_*.' + self.table_fmt))
         if len(xls_files) > 0:
             self.XLs_restraint = True
             self.ambiguous_XLs_restraint = False
             for f in xls_files:
-                k = f.split('XLs_info_')[-1].split('.csv')[0]
-                df = pd.read_csv(f)
+                k = f.split('XLs_info_')[-1].split('.' + self.table_fmt)[0]
+                df = self.read_table(f)
                 self.S_dist_all[k] = df
 
             # Check for ambiguity
@@ -822,42 +1093,54 @@ class AnalysisTrajectories(object):
         else:
             print('No files with XLs info found')
 
+    def get_column_dtype(self, column):
+        '''
+        Get the dtype of a column of a table written by write_table,
+        the same as when reading the stat files
+        '''
+        if column in ['traj', 'rmf3_file', 'half']:
+            return str
+        elif self.keep_double_precision(column):
+            return np.float64
+        return np.float32
+
     def hdbscan_clustering(self, selected_scores, min_cluster_size=150,
                            min_samples=5, skip=1):
         '''
         DO HDBSCAN clustering for selected restraint and/or nuisance parameters
         '''
 
-        all_dfs = [self.S_all[dd] for dd in np.sort(self.S_all.keys())]
-        S_comb = pd.concat(all_dfs)
+        # Skip frames of each trajectory before combining them
+        all_dfs = [self.S_all[dd].iloc[::skip] for dd in sorted(self.S_all)]
+        S_comb_all = pd.concat(all_dfs)
 
         # Print all available fields before checking if field exists.
-        print('All available fields: ', S_comb.columns.values)
-        S_comb_sel = S_comb[selected_scores].iloc[::skip]
-        S_comb_all = S_comb.iloc[::skip]
-        print('Fields selected for HDBSCAN clustering: ',
-              S_comb_sel.columns.values)
-
-        hdbsc = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size,
-                                min_samples=min_samples).fit(S_comb_sel)
+        print('All available fields: ', S_comb_all.columns.values)
+        # cuml works in single precision, the CPU backends get the
+        # scores in double precision
+        dtype = np.float32 if hdbscan_backend == 'cuml' else np.float64
+        scores_sel = np.column_stack(
+            [S_comb_all[s].to_numpy(dtype=dtype) for s in selected_scores])
+        print('Fields selected for HDBSCAN clustering: ', selected_scores)
+
+        options = {'min_cluster_size': min_cluster_size,
+                   'min_samples': min_samples}
+        if hdbscan_backend == 'cuml':
+            options['output_type'] = 'numpy'
+        print('Clustering with', hdbscan_backend)
+        hdbsc = HDBSCAN(**options).fit(scores_sel)
 
         # Add clusters labels
-        S_comb_sel = S_comb_sel.assign(cluster=pd.Series(
-            hdbsc.labels_, index=S_comb_sel.index).values)
-        S_comb_all = S_comb_all.assign(cluster=pd.Series(
-            hdbsc.labels_, index=S_comb_all.index).values)
+        S_comb_all['cluster'] = hdbsc.labels_
 
         # Add cluster labels also to XLs info if available
         if self.XLs_restraint is True:
 
-            all_dist_dfs = [self.S_dist_all[dd]
-                            for dd in np.sort(self.S_dist_all.keys())]
-            S_comb_dist_clustering = pd.concat(
-                all_dist_dfs, sort=False).iloc[::skip]
+            all_dist_dfs = [self.S_dist_all[dd].iloc[::skip]
+                            for dd in sorted(self.S_dist_all)]
+            S_comb_dist_clustering = pd.concat(all_dist_dfs, sort=False)
 
-            S_comb_dist_clustering = S_comb_dist_clustering.assign(
-                cluster=pd.Series(hdbsc.labels_,
-                                  index=S_comb_dist_clustering.index).values)
+            S_comb_dist_clustering['cluster'] = hdbsc.labels_
             S_comb_dist_clustering.to_csv(os.path.join(
                 self.analysis_dir, 'XLs_clustering_info.csv'), index=False)
             self.S_comb_dist_clustering = S_comb_dist_clustering
@@ -866,13 +1149,10 @@ class AnalysisTrajectories(object):
               np.unique(hdbsc.labels_))
 
         # Write and plot info from clustering
-        self.plot_hdbscan_clustering(S_comb_sel, selected_scores)
+        self.plot_hdbscan_clustering(S_comb_all, selected_scores)
         self.write_hdbscan_clustering(S_comb_all)
         self.plot_hdbscan_runs_info(S_comb_all)
 
-        S_comb_sel = S_comb_sel.assign(
-            half=pd.Series(S_comb_all['half'],
-                           index=S_comb_sel.index).values)
         self.write_summary_hdbscan_clustering(
             S_comb_all[['Total_Score']+selected_scores+['half', 'cluster']])
 
@@ -882,15 +1162,15 @@ class AnalysisTrajectories(object):
         (i.e. cluster number, average scores, number of models)
         '''
 
-        aggregation = {v: 'mean' for v in S_comb_all.columns.values
-                       if v not in ['half', 'cluster']}
-        aggregation.update({'cluster': lambda x: len(x),
-                            'half': lambda x: len(x[x == 'A'])})
-
-        S_clusters = S_comb_all.groupby('cluster').agg(aggregation)
+        mean_columns = [v for v in S_comb_all.columns.values
+                        if v not in ['half', 'cluster']]
+        S_clusters = S_comb_all.groupby('cluster')[mean_columns].mean()
 
-        S_clusters.rename(columns={'cluster': 'N_models',
-                                   'half': 'N_A'}, inplace=True)
+        # Number of models of each cluster in each half
+        counts = S_comb_all.groupby(['cluster', 'half']).size().unstack(
+            fill_value=0).reindex(columns=['A'], fill_value=0)
+        S_clusters['N_models'] = S_comb_all.groupby('cluster').size()
+        S_clusters['N_A'] = counts['A']
         S_clusters['N_B'] = S_clusters['N_models'] - S_clusters['N_A']
         S_clusters = S_clusters.sort_values('Total_Score')
 
@@ -1007,10 +1287,12 @@ class AnalysisTrajectories(object):
         if len(clusters) == 0:
             clusters = [-1]
 
-        S_comb.loc[:, 'frame_RMF3'] = S_comb.apply(
-            lambda row: 'h1_'+row.traj+'_'+str(int(row.MC_frame))+'.rmf3'
-            if row.half == 'A'
-            else 'h2_'+row.traj+'_'+str(int(row.MC_frame))+'.rmf3', axis=1)
+        # Name of the rmf3 file of each frame, built column-wise
+        half_prefix = pd.Series(np.where(S_comb['half'] == 'A', 'h1_', 'h2_'),
+                                index=S_comb.index)
+        S_comb.loc[:, 'frame_RMF3'] = (
+            half_prefix + S_comb['traj'] + '_'
+            + S_comb['MC_frame'].astype(int).astype(str) + '.rmf3')
 
         clus_sel = 0
         for cl in clusters:
@@ -1024,27 +1306,23 @@ class AnalysisTrajectories(object):
                 clus_sel += 1
                 n = self.plot_scores_distributions(HA, HB, cl)
 
-                # Write to csv
-                HA.to_csv(os.path.join(
-                    self.analysis_dir,
-                    'selected_models_A_cluster'+str(cl)+'_detailed.csv'))
-                HB.to_csv(os.path.join(
-                    self.analysis_dir,
-                    'selected_models_B_cluster'+str(cl)+'_detailed.csv'))
+                # Write tables
+                self.write_table(
+                    HA, 'selected_models_A_cluster'+str(cl)+'_detailed')
+                self.write_table(
+                    HB, 'selected_models_B_cluster'+str(cl)+'_detailed')
 
                 # Select n model from
                 if int(n) > self.number_models_out or len(HH_cluster) > self.number_models_out:
                     HH_sel = HH_cluster.sample(n=self.number_models_out)
                     HH_sel_A = HH_sel[(HH_sel['half'] == 'A')]
                     HH_sel_B = HH_sel[(HH_sel['half'] == 'B')]
-                    HH_sel_A.to_csv(os.path.join(
-                        self.analysis_dir,
-                        'selected_models_A_cluster' + str(cl)
-                        + '_detailed_random.csv'))
-                    HH_sel_B.to_csv(os.path.join(
-                        self.analysis_dir,
-                        'selected_models_B_cluster' + str(cl)
-                        + '_detailed_random.csv'))
+                    self.write_table(
+                        HH_sel_A, 'selected_models_A_cluster' + str(cl)
+                        + '_detailed_random')
+                    self.write_table(
+                        HH_sel_B, 'selected_models_B_cluster' + str(cl)
+                        + '_detailed_random')
 
         if clus_sel == 0:
             print('WARNING: No models were selected because the '
@@ -1053,36 +1331,31 @@ class AnalysisTrajectories(object):
     def plot_hdbscan_clustering(self, S_comb_sel, selected_scores):
         print('Generating HDBSCAN clustering plot ...')
 
-        palette = color_palette[:len(np.unique(S_comb_sel['cluster']))]
-        cluster_colors = [palette[col] for col in S_comb_sel['cluster']]
+        # Color of each model, from the label of its cluster
+        clusters = S_comb_sel['cluster'].to_numpy()
+        palette = np.array(color_palette[:len(np.unique(clusters))])
+        cluster_colors = palette[clusters]
+        scores = {s: S_comb_sel[s].to_numpy() for s in selected_scores}
 
         n_sel = len(selected_scores)
-        fig = pl.figure(figsize=(2*n_sel, 2*n_sel))
-        gs = gridspec.GridSpec(n_sel, n_sel)
-        i = 0
-        for s1, s2 in itertools.product(selected_scores, repeat=2):
-            ax = pl.subplot(gs[i])
+        fig, axes = pl.subplots(n_sel, n_sel, figsize=(2*n_sel, 2*n_sel),
+                                squeeze=False)
+        axes = axes.ravel()
+        for i, (s1, s2) in enumerate(
+                itertools.product(selected_scores, repeat=2)):
             if s1 == s2:
-                ax.hist(S_comb_sel[s1], 20, histtype='step', color='b',
-                        alpha=0.5)
+                axes[i].hist(scores[s1], 20, histtype='step', color='b',
+                             alpha=0.5)
             else:
-                ax.scatter(S_comb_sel[s2], S_comb_sel[s1],
-                           c=np.array(cluster_colors), s=3.0, alpha=0.3)
-
-            i += 1
+                axes[i].scatter(scores[s2], scores[s1], c=cluster_colors,
+                                s=3.0, alpha=0.3)
 
         # Add horizontal labels (top plots)
         for i in range(n_sel):
-            fig.get_axes()[i].set_title('%s' % (selected_scores[i]),
-                                        fontsize=12)
+            axes[i].set_title('%s' % (selected_scores[i]), fontsize=12)
         # Add vertical labels
-        fig.get_axes()[0].set_ylabel('%s' % (selected_scores[0]),
-                                     fontsize=12)
-        k = 1
-        for i in range(n_sel, n_sel*n_sel, n_sel):
-            fig.get_axes()[i].set_ylabel('%s' % (selected_scores[k]),
-                                         fontsize=12)
-            k += 1
+        for k, i in enumerate(range(0, n_sel*n_sel, n_sel)):
+            axes[i].set_ylabel('%s' % (selected_scores[k]), fontsize=12)
 
         pl.tight_layout(pad=1.2, w_pad=1.5, h_pad=2.5)
         fig.savefig(
@@ -1091,27 +1364,15 @@ class AnalysisTrajectories(object):
 
     def do_extract_models(self, gsms_info, filename, gsms_dir):
 
-        self.scores = self.manager.list()
-
-        # Split the DF
-        df_array = np.array_split(gsms_info, self.nproc)
-
-        # Setup a list of processes that we want to run
-        processes = [mp.Process(target=self.extract_models,
-                                args=(df_array[x], filename, gsms_dir))
-                     for x in range(self.nproc)]
-
-        # Run processes
-        for p in processes:
-            p.start()
-
-        # Exit the completed processes
-        for p in processes:
-            p.join()
+        models = self.get_models_files(gsms_info, filename, gsms_dir)
+        with mp.Pool(self.nproc) as p:
+            extracted = p.map(AnalysisTrajectories.extract_model, models)
 
-        # Write scores to file
-        np.savetxt(
-            os.path.join(gsms_dir, filename+'.txt'), np.array(self.scores))
+        # Write scores to file, in the same order as the models
+        self.scores = list(gsms_info['Total_Score'])
+        np.savetxt(os.path.join(gsms_dir, filename+'.txt'),
+                   np.array(self.scores))
+        return self.report_failed_models(models, extracted)
 
     def write_GSMs_info(self, gsms_info, filename):
         gsms_info.to_csv(
@@ -1119,7 +1380,7 @@ class AnalysisTrajectories(object):
 
     def get_models_to_extract(self, f):
         # Get models to extract from file
-        DD = pd.read_csv(f)
+        DD = tools.read_table(f)
         return DD
 
     def get_sample_of_models_to_extract(self, file_A, file_B):
@@ -1132,22 +1393,54 @@ class AnalysisTrajectories(object):
 
     def extract_models(self, gsms_info, filename, gsms_dir):
         '''
-        Use rmf_slice to extract the GSMs
+        Use rmf_slice to extract the GSMs, one after the other.
+        Returns the models that could not be extracted
         '''
-        for row in gsms_info.itertuples():
-            ID = row.traj
-            fr = int(row.MC_frame)
-            fr_rmf = int(row.rmf_frame_index)
-            rmf_file = row.rmf3_file
-            traj_in = os.path.join(ID, rmf_file)
-            file_out = os.path.join(
-                gsms_dir, filename+'_'+str(ID)+'_'+str(fr)+'.rmf3')
-
-            os.system('rmf_slice -q ' + traj_in + ' ' + file_out
-                      + ' --frame ' + str(fr_rmf))
+        models = self.get_models_files(gsms_info, filename, gsms_dir)
+        extracted = [AnalysisTrajectories.extract_model(model)
+                     for model in models]
+        self.scores = list(gsms_info['Total_Score'])
+        return self.report_failed_models(models, extracted)
 
-            # Collect scores
-            self.scores.append(row.Total_Score)
+    def get_models_files(self, gsms_info, filename, gsms_dir):
+        '''
+        Get the input trajectory, output file and RMF frame of each GSM
+        '''
+        # check if rmf_slice is available
+        if not shutil.which('rmf_slice'):
+            raise RuntimeError("rmf_slice binary not found on path.")
+
+        return [
+            (os.path.join(traj, rmf3_file),
+             os.path.join(gsms_dir,
+                          filename+'_'+str(traj)+'_'+str(int(fr))+'.rmf3'),
+             int(fr_rmf))
+            for traj, fr, fr_rmf, rmf3_file in zip(
+                gsms_info['traj'], gsms_info['MC_frame'],
+                gsms_info['rmf_frame_index'], gsms_info['rmf3_file'])]
+
+    def report_failed_models(self, models, extracted):
+        '''
+        Print the models that rmf_slice failed to extract, and return them
+        '''
+        failed = [model for model, ok in zip(models, extracted) if not ok]
+        if failed:
+            print('Could not extract', len(failed), 'of', len(models),
+                  'models:')
+            for traj_in, file_out, fr_rmf in failed:
+                print(traj_in, 'frame', fr_rmf, '->', file_out)
+        return failed
+
+    @staticmethod
+    def extract_model(model):
+        '''
+        Use rmf_slice to extract a GSM.
+        Returns whether it was extracted
+        '''
+        traj_in, file_out, fr_rmf = model
+        result = subprocess.run(['rmf_slice', '-q', traj_in, file_out,
+                                 '--frame', str(fr_rmf)])
+        return result.returncode == 0
 
     def do_extract_models_single_rmf(
             self, gsms_info, out_rmf_name, traj_dir, analysis_dir,
@@ -1171,8 +1464,6 @@ class AnalysisTrajectories(object):
                each trajectory directory
         '''
 
-        self.scores = self.manager.list()
-
         # Split the DF into pieces based on trajectory
 
         # Find the number of trajectories
@@ -1295,7 +1586,7 @@ class AnalysisTrajectories(object):
         '''
         if os.path.isdir(d):
             os.rename(d, '%s.old_%d' % (d, random.randint(0, 100)))
-        os.mkdir(d)
+        os.makedirs(d)
 
     def plot_scores_distributions(self, HA, HB, cl):
         '''
@@ -1334,19 +1625,21 @@ class AnalysisTrajectories(object):
                           min(len(scores_A), len(scores_B)),
                           int(min(len(scores_A), len(scores_B))/10.))
 
-        RH1 = []
-        RH2 = []
-        for m in M[1:]:
-            D1 = []
-            D2 = []
-            for d in range(20):
-                D1.append(min(random.sample(list(scores_A), m)))
-                D2.append(min(random.sample(list(scores_B), m)))
-            RH1.append((m, np.mean(D1), np.std(D1)))
-            RH2.append((m, np.mean(D2), np.std(D2)))
-
-        RH1 = np.array(RH1)
-        RH2 = np.array(RH2)
+        # Minimum score of 20 random samples of m models of each half.
+        # Each sample, without replacement, is given by the m lowest
+        # of a set of random keys for all models.
+        rng = np.random.default_rng()
+        sA = scores_A.to_numpy()
+        sB = scores_B.to_numpy()
+        RH1 = np.empty((len(M[1:]), 3))
+        RH2 = np.empty((len(M[1:]), 3))
+        for i, m in enumerate(M[1:]):
+            D1 = sA[np.argpartition(rng.random((20, len(sA))), m-1,
+                                    axis=1)[:, :m]].min(axis=1)
+            D2 = sB[np.argpartition(rng.random((20, len(sB))), m-1,
+                                    axis=1)[:, :m]].min(axis=1)
+            RH1[i] = (m, np.mean(D1), np.std(D1))
+            RH2[i] = (m, np.mean(D2), np.std(D2))
 
         hits = 0
         n = 0
@@ -1385,36 +1678,20 @@ class AnalysisTrajectories(object):
         Input: DF with XLs distances
         Output: Dictionary of XLs that should be treated as ambiguous
         '''
-        xls_ids = {}
+        # XLs distances, grouped by the id of the XL
+        # (i.e. the integer part of the third field of the name)
+        keys = pd.Series(list(all_keys), dtype=object)
+        keys = keys[keys.str.contains('Distance_', regex=False)]
+        ids = keys.str.extract(XLs_id_pattern, expand=False)
 
         if self.Multiple_XLs_restraints:
+            xls_ids = {}
             for type_XLs in self.XLs_cutoffs.keys():
-                xls_ids[type_XLs] = {}
-                for i, xl in enumerate(all_keys):
-                    if ('Distance_' in xl) and (type_XLs in xl):
-                        vals = xl.split('|')
-                        id = vals[2].split('.')[0]
-                        # p1 = vals[3].split('.')[0]
-                        # r1 = vals[4]
-                        # p2 = vals[5].split('.')[0]
-                        # r2 = vals[6]
-                        if id in xls_ids[type_XLs].keys():
-                            xls_ids[type_XLs][id].append(xl)
-                        else:
-                            xls_ids[type_XLs][id] = [xl]
+                sel = keys.str.contains(type_XLs, regex=False)
+                xls_ids[type_XLs] = keys[sel].groupby(
+                    ids[sel], sort=False).agg(list).to_dict()
         else:
-            for i, xl in enumerate(all_keys):
-                if ('Distance_' in xl):
-                    vals = xl.split('|')
-                    id = vals[2].split('.')[0]
-                    # p1 = vals[3].split('.')[0]
-                    # r1 = vals[4]
-                    # p2 = vals[5].split('.')[0]
-                    # r2 = vals[6]
-                    if id in xls_ids.keys():
-                        xls_ids[id].append(xl)
-                    else:
-                        xls_ids[id] = [xl]
+            xls_ids = keys.groupby(ids, sort=False).agg(list).to_dict()
         return xls_ids
 
     def get_psi_stats(self):
@@ -1430,15 +1707,14 @@ class AnalysisTrajectories(object):
                        if ('OccamsRestraint' in k) and ('psi' in k)]
         all_nuis = XLs_nuis + occams_nuis
         stats_nuis = sum([['mean_'+i, 'std_'+i] for i in all_nuis], [])
-        DF_stat_nuis = pd.DataFrame(columns=['traj'] + stats_nuis)
 
+        # Collect one row per trajectory, then build the DataFrame once
+        rows = []
         for k, v in self.S_info_all.items():
             sel_nuis_mean = list(v[all_nuis].mean())
             sel_nuis_std = list(v[all_nuis].std())
-            DF_stat_nuis = DF_stat_nuis.append(
-                pd.Series([k]+sel_nuis_mean+sel_nuis_std,
-                          index=DF_stat_nuis.columns.values),
-                ignore_index=True)
+            rows.append([k]+sel_nuis_mean+sel_nuis_std)
+        DF_stat_nuis = pd.DataFrame(rows, columns=['traj'] + stats_nuis)
 
         DF_stat_nuis.to_csv(os.path.join(self.analysis_dir,
                                          'Stat_all_nuisances.csv'))
@@ -1456,8 +1732,7 @@ class AnalysisTrajectories(object):
                 XLs_satif = self.get_XLs_satisfaction(S_dist, atomic_XLs,
                                                       type_XLs=type_XLs)
                 temp_name = 'XLs_satif_'+type_XLs.rstrip()
-                S_info = S_info.assign(XLs_satif=pd.Series(XLs_satif))
-                S_info.rename(columns={'XLs_satif': temp_name}, inplace=True)
+                S_info[temp_name] = XLs_satif
                 XLs_satif_fields.append(temp_name)
         elif self.Multiple_psi_values:
             all_psis = [v.split(psi_head)[1]
@@ -1467,12 +1742,11 @@ class AnalysisTrajectories(object):
                 XLs_satif = self.get_XLs_satisfaction(S_dist, atomic_XLs,
                                                       type_psi=type_psi)
                 temp_name = 'XLs_satif_'+type_psi
-                S_info = S_info.assign(XLs_satif=pd.Series(XLs_satif))
-                S_info.rename(columns={'XLs_satif': temp_name}, inplace=True)
+                S_info[temp_name] = XLs_satif
                 XLs_satif_fields.append(temp_name)
         else:
             XLs_satif = self.get_XLs_satisfaction(S_dist, atomic_XLs)
-            S_info = S_info.assign(XLs_satif=pd.Series(XLs_satif))
+            S_info['XLs_satif'] = XLs_satif
             XLs_satif_fields.append('XLs_satif')
 
         file_out_xls = 'plot_XLs_%s.%s' % (traj_number, self.plot_fmt)
@@ -1482,52 +1756,80 @@ class AnalysisTrajectories(object):
 
     def get_XLs_satisfaction(self, S_dist, atomic_XLs, type_XLs=None,
                              type_psi=None):
+        key = (tuple(S_dist.columns.values), atomic_XLs, type_XLs, type_psi,
+               self.ambiguous_XLs_restraint, self.Multiple_XLs_restraints,
+               tuple(self.XLs_cutoffs.items()))
+        if key not in self.XLs_columns:
+            self.XLs_columns[key] = self.get_XLs_columns(
+                S_dist.columns.values, atomic_XLs, type_XLs, type_psi)
+        dist_idx, groups, cutoff = self.XLs_columns[key]
+
+        # Only distance columns
+        XLs_dists = S_dist.iloc[:, dist_idx].to_numpy()
+
+        # Check for ambiguity, keep the shortest distance of each XL,
+        # reducing the distances of all XLs in a single call
+        if groups is not None:
+            groups_idx, groups_start = groups
+            XLs_dists = np.fmin.reduceat(XLs_dists[:, groups_idx],
+                                         groups_start, axis=1)
+
+        perc_per_step = (XLs_dists <= cutoff).mean(axis=1)
+
+        return perc_per_step
+
+    def get_XLs_columns(self, columns, atomic_XLs, type_XLs=None,
+                        type_psi=None):
+        '''
+        Get the positions of the XLs distance columns, the positions
+        of the distances of each ambiguous XL among them, and the cutoff.
+        The positions of the ambiguous XLs are given as a flat array with
+        the distances of each XL next to each other, and the start of each
+        XL in that array.
+        '''
         if type_XLs and not type_psi:
             dist_columns = [
-                x for x in S_dist.columns.values
+                x for x in columns
                 if ('Distance_' in x and type_XLs in x)]
             cutoff = self.XLs_cutoffs[type_XLs]
         elif type_psi and not type_XLs:
             dist_columns = [
-                x for x in S_dist.columns.values
+                x for x in columns
                 if ('Distance_' in x and type_psi in x)]
             cutoff = list(self.XLs_cutoffs.values())[0]
         elif type_XLs and type_psi:
             dist_columns = [
-                x for x in S_dist.columns.values
+                x for x in columns
                 if ('Distance_' in x and type_XLs in x and type_psi in x)]
             cutoff = self.XLs_cutoffs[type_XLs]
         elif atomic_XLs:
-            dist_columns = [x for x in S_dist.columns.values
+            dist_columns = [x for x in columns
                             if ('BestDist' in x)]
             cutoff = list(self.XLs_cutoffs.values())[0]
         else:
-            dist_columns = [x for x in S_dist.columns.values
+            dist_columns = [x for x in columns
                             if 'Distance_' in x]
             cutoff = list(self.XLs_cutoffs.values())[0]
 
-        # Only distance columns
-        XLs_dists = S_dist[dist_columns]
+        column_ids = {v: i for i, v in enumerate(columns)}
+        dist_idx = np.array([column_ids[c] for c in dist_columns],
+                            dtype=np.int64)
 
-        # Check for ambiguity
+        groups = None
         if self.ambiguous_XLs_restraint is True:
-            ambiguous_XLs_dict = \
-                self.check_XLs_ambiguity(S_dist.columns.values)
-            min_XLs = pd.DataFrame()
+            ambiguous_XLs_dict = self.check_XLs_ambiguity(columns)
             if self.Multiple_XLs_restraints:
-                for k, v in ambiguous_XLs_dict[type_XLs].items():
-                    min_XLs[k] = XLs_dists[v].min(axis=1)
-            else:
-                for k, v in ambiguous_XLs_dict.items():
-                    min_XLs[k] = XLs_dists[v].min(axis=1)
-            perc_per_step = list(
-                min_XLs.apply(lambda x: sum(x <= cutoff)/len(x), axis=1))
-
-        else:
-            perc_per_step = list(
-                XLs_dists.apply(lambda x: sum(x <= cutoff)/len(x), axis=1))
-
-        return perc_per_step
+                ambiguous_XLs_dict = ambiguous_XLs_dict[type_XLs]
+            dist_ids = {v: i for i, v in enumerate(dist_columns)}
+            groups_idx = np.array(
+                [dist_ids[c] for v in ambiguous_XLs_dict.values() for c in v],
+                dtype=np.int64)
+            groups_start = np.cumsum(
+                [0] + [len(v) for v in ambiguous_XLs_dict.values()],
+                dtype=np.int64)[:-1]
+            groups = (groups_idx, groups_start)
+
+        return dist_idx, groups, cutoff
 
     def summarize_XLs_info(self, Multiple_XLs_restraints=False,
                            ambiguous_XLs_restraint=False):
@@ -1552,32 +1854,38 @@ class AnalysisTrajectories(object):
         except:  # noqa: E722
             self.ambiguous_XLs_restraint = ambiguous_XLs_restraint
 
-        unique_clusters = np.sort(
-            list(set(self.S_comb_dist_clustering['cluster'])))
+        # Rows of each cluster, selected once for all plots and files
+        S_clusters = dict(list(
+            self.S_comb_dist_clustering.groupby('cluster')))
+        unique_clusters = np.array(list(S_clusters.keys()))
         print('Summarize XLs, unique_clusters', unique_clusters)
         if self.Multiple_XLs_restraints:
             for type_XLs in self.XLs_cutoffs.keys():
                 cutoff = self.XLs_cutoffs[type_XLs]
-                for cl in unique_clusters:
+                for cl, S_cluster in S_clusters.items():
                     # Boxplot XLs distances
                     self.boxplot_XLs_distances(cluster=cl, type_XLs=type_XLs,
-                                               cutoff=cutoff)
+                                               cutoff=cutoff,
+                                               S_cluster=S_cluster)
                     # XLs satisfaction data
-                    self.get_XLs_details(cluster=cl, type_XLs=type_XLs)
+                    self.get_XLs_details(cluster=cl, type_XLs=type_XLs,
+                                         S_cluster=S_cluster)
         else:
             cutoff = list(self.XLs_cutoffs.values())[0]
-            for cl in unique_clusters:
+            for cl, S_cluster in S_clusters.items():
                 # Boxplot XLs distances
-                self.boxplot_XLs_distances(cluster=cl, cutoff=cutoff)
+                self.boxplot_XLs_distances(cluster=cl, cutoff=cutoff,
+                                           S_cluster=S_cluster)
                 # XLs satisfaction data
-                self.get_XLs_details(cluster=cl)
+                self.get_XLs_details(cluster=cl, S_cluster=S_cluster)
 
         # XLs satisfaction data for all models
         self.get_XLs_details(cluster='All')
 
-    def get_XLs_details(self, cluster=0, type_XLs=None):
+    def get_XLs_details(self, cluster=0, type_XLs=None, S_cluster=None):
         '''
         For GSM, determine for each XLs how often it is satisfied.
+        S_cluster are the rows of the cluster, if already selected.
         '''
         if type_XLs:
             dist_columns = [
@@ -1591,21 +1899,30 @@ class AnalysisTrajectories(object):
                 if 'Distance' in v]
             cutoff = list(self.XLs_cutoffs.values())[0]
 
-        if cluster != 'All':
+        if S_cluster is not None:
+            dXLs_cluster = S_cluster.loc[:, dist_columns]
+        elif cluster != 'All':
             dXLs_cluster = self.S_comb_dist_clustering.loc[
                 self.S_comb_dist_clustering['cluster'] == cluster,
                 dist_columns]
         else:
             dXLs_cluster = self.S_comb_dist_clustering.loc[:, dist_columns]
 
-        stats_XLs = pd.DataFrame()
-        stats_XLs['mean'] = dXLs_cluster.mean()
-        stats_XLs['std'] = dXLs_cluster.std()
-        stats_XLs['min'] = dXLs_cluster.min()
-        stats_XLs['max'] = dXLs_cluster.max()
-
-        stats_XLs['perc_satif'] = dXLs_cluster.apply(
-            lambda x: float(len(x[x < cutoff])) / float(len(x)), axis=0)
+        # All statistics from a single array of distances
+        dists = dXLs_cluster.to_numpy()
+        if len(dists) == 0:
+            # No models selected, nanmin and nanmax would raise
+            stats_XLs = pd.DataFrame(
+                np.nan, index=dXLs_cluster.columns,
+                columns=['mean', 'std', 'min', 'max', 'perc_satif'])
+        else:
+            stats_XLs = pd.DataFrame({
+                'mean': np.nanmean(dists, axis=0),
+                'std': np.nanstd(dists, axis=0, ddof=1),
+                'min': np.nanmin(dists, axis=0),
+                'max': np.nanmax(dists, axis=0),
+                'perc_satif': (dists < cutoff).mean(axis=0)},
+                index=dXLs_cluster.columns)
 
         if type_XLs:
             stats_XLs.to_csv(
@@ -1699,7 +2016,12 @@ class AnalysisTrajectories(object):
         fig.savefig(os.path.join(self.analysis_dir, file_out))
         pl.close()
 
-    def boxplot_XLs_distances(self, cluster=0, type_XLs=None, cutoff=30.0):
+    def boxplot_XLs_distances(self, cluster=0, type_XLs=None, cutoff=30.0,
+                              S_cluster=None):
+        '''
+        Plot the distributions of XLs distances of a cluster.
+        S_cluster are the rows of the cluster, if already selected.
+        '''
         if type_XLs:
             file_out = 'plot_XLs_distance_distributions_cl' + str(cluster) \
                 + '_' + str(type_XLs) + '.' + self.plot_fmt
@@ -1715,8 +2037,12 @@ class AnalysisTrajectories(object):
             dist_columns = [
                 x for x in self.S_comb_dist_clustering.columns.values
                 if 'Distance_' in x]
-        dXLs_cluster = self.S_comb_dist_clustering.loc[
-            self.S_comb_dist_clustering['cluster'] == cluster, dist_columns]
+        if S_cluster is not None:
+            dXLs_cluster = S_cluster.loc[:, dist_columns]
+        else:
+            dXLs_cluster = self.S_comb_dist_clustering.loc[
+                self.S_comb_dist_clustering['cluster'] == cluster,
+                dist_columns]
 
         dXLs_unique = pd.DataFrame()
         if self.ambiguous_XLs_restraint is True:
@@ -1735,24 +2061,16 @@ class AnalysisTrajectories(object):
             dXLs_unique = dXLs_cluster
 
         # Get distances and order based on the mean
-        columns = ['entry', 'mean', 'id']
-        XLs_ids = pd.DataFrame(columns=columns)
-        min_all = []
-        for i, v in enumerate(dXLs_unique.columns.values):
-            m = np.mean(dXLs_unique[v])
-            ll = v.split('_|')[1]
-            label = '|'.join(ll.split('|')[2:6])
-            if m > 0:
-                XLs_ids = XLs_ids.append(
-                    pd.Series([int(i), m, label], index=columns),
-                    ignore_index=True)
-                min_all.append(m)
-        XLs_ids = XLs_ids.sort_values(by=['mean'])
-        labels_ordered = XLs_ids['id'].values
+        means = dXLs_unique.mean().to_numpy()
+        labels = np.array(['|'.join(v.split('_|')[1].split('|')[2:6])
+                           for v in dXLs_unique.columns.values])
+        entries = np.flatnonzero(means > 0)
+        min_all = list(means[entries])
+        entries = entries[np.argsort(means[entries], kind='stable')]
+        labels_ordered = labels[entries]
 
         # For plot layout
-        S_sorted = np.array(
-            dXLs_unique)[:, XLs_ids['entry'].values.astype('int')]
+        S_sorted = dXLs_unique.to_numpy()[:, entries]
         n_xls = len(labels_ordered)
         n_plots = int(math.ceil(n_xls/50.0))
         n_frac = int(math.ceil(n_xls/float(n_plots)))
@@ -1882,15 +2200,23 @@ class AnalysisTrajectories(object):
         fig.savefig(os.path.join(self.analysis_dir, file_out))
         pl.close()
 
-    def substrings(self, s):
-        for i in range(len(s)):
-            for j in range(i, len(s)):
-                yield s[i:j+1]
-
     def get_str_match(self, strs):
+        '''
+        Longest common substring of the first two strings, using
+        the lengths of the common suffixes of their prefixes
+        '''
         if len(strs) > 1:
-            intersect = \
-                set(self.substrings(strs[0])) & set(self.substrings(strs[1]))
-            return max(intersect, key=len)
+            a, b = strs[0], strs[1]
+            max_len, end = 0, 0
+            prev = [0] * (len(b) + 1)
+            for i in range(1, len(a) + 1):
+                curr = [0] * (len(b) + 1)
+                for j in range(1, len(b) + 1):
+                    if a[i-1] == b[j-1]:
+                        curr[j] = prev[j-1] + 1
+                        if curr[j] > max_len:
+                            max_len, end = curr[j], i
+                prev = curr
+            return a[end-max_len:end]
         else:
             return strs[0]
@@ -6,6 +6,23 @@
 from __future__ import print_function
 import os
 import glob
+import pandas as pd
+
+
+def read_table(f, index_col=None, column_dtype=None):
+    '''
+    Read a table of models written as csv, zstd compressed csv or
+    parquet, depending on the extension of the file.
+    For csv files, column_dtype gives the dtype of a column from its name.
+    Parquet files keep their own index and dtypes.
+    '''
+    if f.endswith('.parquet'):
+        return pd.read_parquet(f)
+    dtype = None
+    if column_dtype is not None:
+        columns = pd.read_csv(f, index_col=index_col, nrows=0).columns
+        dtype = {c: column_dtype(c) for c in columns}
+    return pd.read_csv(f, index_col=index_col, dtype=dtype)
 
 
 class ReadClustering(object):
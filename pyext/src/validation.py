@@ -29,13 +29,20 @@ class ValidationModels(object):
                  clustering_dir,
                  scores_sample_A,
                  scores_sample_B,
-                 XLs_cutoffs):
+                 XLs_cutoffs,
+                 table_fmt='csv'):
+        '''
+        @table_fmt: file format of the tables of models written by
+        AnalysisTrajectories, one of csv, csv.zst or parquet.
+        Default is csv.
+        '''
 
         self.analysis_dir = analysis_dir
         self.clustering_dir = clustering_dir
         self.scores_sample_A = scores_sample_A
         self.scores_sample_B = scores_sample_B
         self.XLs_cutoffs = XLs_cutoffs
+        self.table_fmt = table_fmt
 
         print(self.clustering_dir)
 
@@ -48,8 +55,8 @@ class ValidationModels(object):
 
     def read_scores_files(self):
         # Read scores from file
-        S1 = pd.read_csv(self.scores_sample_A, sep=',')
-        S2 = pd.read_csv(self.scores_sample_B, sep=',')
+        S1 = tools.read_table(self.scores_sample_A)
+        S2 = tools.read_table(self.scores_sample_B)
         self.S = pd.concat([S1, S2])
 
         if 'frame_RMF3' not in self.S.columns:
@@ -196,8 +203,8 @@ class ValidationModels(object):
             for t in trajs:
                 frames = sel_cluster[
                     sel_cluster['traj'] == 'run_'+t]['MC_frame']
-                dist = pd.read_csv(self.analysis_dir + '/XLs_dist_info_'
-                                   + str(t) + '.csv')
+                dist = tools.read_table(self.analysis_dir + '/XLs_dist_info_'
+                                        + str(t) + '.' + self.table_fmt)
                 dist_cluster = dist[dist['MC_frame'].isin(frames)]
                 if not dist_all.empty:
                     dist_all.append(dist_cluster)
@@ -315,8 +322,9 @@ class ValidationModels(object):
             for t in trajs:
                 frames = \
                     sel_cluster[sel_cluster['traj'] == 'run_'+t]['MC_frame']
-                info = pd.read_csv(os.path.join(
-                    self.analysis_dir, 'other_info_'+str(t)+'.csv'))
+                info = tools.read_table(os.path.join(
+                    self.analysis_dir,
+                    'other_info_'+str(t)+'.'+self.table_fmt))
                 info_cluster = info[info['MC_frame'].isin(frames)]
                 if not info_all.empty:
                     info_all.append(info_cluster)